@@ -15,7 +15,7 @@ from zope.interface.verify import verifyObject, verifyClass
 from zope.interface import implementer
 
 from twisted.logger import globalLogPublisher, LogLevel
-from twisted.python.compat import iteritems, networkString
+from twisted.python.compat import networkString
 from twisted.python.failure import Failure
 from twisted.python.filepath import FilePath
 from twisted.python.log import msg
@@ -58,6 +58,15 @@ if requireModule('cryptography') and requireModule('pyasn1.type'):
         _ExistingConnectionHelper)
 
     from twisted.conch.ssh.transport import SSHClientTransport
+
+    # Parsing the well-known test keys is comparatively expensive, and the
+    # resulting objects are never mutated, so share them between all tests.
+    _publicRSAKey = Key.fromString(data=publicRSA_openssh)
+    _privateRSAKey = Key.fromString(data=privateRSA_openssh)
+    _privateDSAKey = Key.fromString(data=privateDSA_openssh)
+    # A second RSA key, distinct from the one above, for host key mismatches.
+    _differentRSAKey = Key.fromString(
+        privateRSA_openssh_encrypted_aes, passphrase=b'testxp').public()
 else:
     skip = "can't run w/o cryptography and pyasn1"
     SSHFactory = object  # type: ignore[assignment,misc]
@@ -69,11 +78,33 @@ else:
     KnownHostsFile = object  # type: ignore[assignment,misc]
     SSHPublicKeyChecker = object  # type: ignore[assignment,misc]
     ConchUser = object  # type: ignore[assignment,misc]
+    _publicRSAKey = _privateRSAKey = _privateDSAKey = None
+    _differentRSAKey = None
 
 from twisted.test.proto_helpers import StringTransport
 from twisted.test.iosim import FakeTransport, connect
 
 
+# The tests only ever call buildProtocol on the protocol factory they pass to
+# an endpoint, so they can all share one.
+_clientFactory = Factory.forProtocol(Protocol)
+
+
+
+def _unsavedKnownHosts():
+    """
+    Create an empty L{KnownHostsFile} for a test which only adds entries to it
+    in memory.
+
+    A new L{KnownHostsFile} never reads its path, and nothing is written to it
+    unless it is saved, so there is no need to create a temporary file for it.
+
+    @rtype: L{KnownHostsFile}
+    """
+    return KnownHostsFile(FilePath(os.devnull))
+
+
+
 class AbortableFakeTransport(FakeTransport):
     """
     A L{FakeTransport} with added C{abortConnection} support.
@@ -205,18 +236,13 @@ class FakeClockSSHUserAuthServer(SSHUserAuthServer):
 
 
 class CommandFactory(SSHFactory):
-    @property
-    def publicKeys(self):
-        return {
-            b'ssh-rsa': Key.fromString(data=publicRSA_openssh)
-            }
-
+    publicKeys = {
+        b'ssh-rsa': _publicRSAKey
+    }
 
-    @property
-    def privateKeys(self):
-        return {
-            b'ssh-rsa': Key.fromString(data=privateRSA_openssh)
-            }
+    privateKeys = {
+        b'ssh-rsa': _privateRSAKey
+    }
 
     services = {
         b'ssh-userauth': FakeClockSSHUserAuthServer,
@@ -275,6 +301,13 @@ class SingleUseMemoryEndpoint(object):
 
 
 
+# The password checker is never modified by the tests, so one instance knowing
+# the well-known account used by SSHCommandClientEndpointTestsMixin is shared.
+_passwordDatabase = InMemoryUsernamePasswordDatabaseDontUse()
+_passwordDatabase.addUser(b"user", b"password")
+
+
+
 class SSHCommandClientEndpointTestsMixin(object):
     """
     Tests for L{SSHCommandClientEndpoint}, an L{IStreamClientEndpoint}
@@ -295,9 +328,10 @@ class SSHCommandClientEndpointTestsMixin(object):
         self.password = b"password"
         self.reactor = MemoryReactorClock()
         self.realm = TrivialRealm()
+        # Tests add checkers to the portal and channel types to the realm, so
+        # each test gets its own of these.
         self.portal = Portal(self.realm)
-        self.passwdDB = InMemoryUsernamePasswordDatabaseDontUse()
-        self.passwdDB.addUser(self.user, self.password)
+        self.passwdDB = _passwordDatabase
         self.portal.registerChecker(self.passwdDB)
         self.factory = CommandFactory()
         self.factory.reactor = self.reactor
@@ -377,9 +411,7 @@ class SSHCommandClientEndpointTestsMixin(object):
         """
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.finishConnection()
 
@@ -406,9 +438,7 @@ class SSHCommandClientEndpointTestsMixin(object):
         self.realm.channelLookup[b'session'] = BrokenExecSession
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.finishConnection()
 
@@ -428,9 +458,7 @@ class SSHCommandClientEndpointTestsMixin(object):
         self.realm.channelLookup[b'session'] = UnsatisfiedExecSession
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
         server, client, pump = self.finishConnection()
 
         connected.cancel()
@@ -475,9 +503,7 @@ class SSHCommandClientEndpointTestsMixin(object):
         self.realm.channelLookup[b'session'] = WorkingExecSession
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.finishConnection()
 
@@ -494,23 +520,21 @@ class SSHCommandClientEndpointTestsMixin(object):
         self.realm.channelLookup[b'session'] = WorkingExecSession
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.finishConnection()
 
         protocol = self.successResultOf(connected)
-        dataReceived = []
-        protocol.dataReceived = dataReceived.append
+        dataReceived = bytearray()
+        protocol.dataReceived = dataReceived.extend
 
         # Figure out which channel on the connection this protocol is
         # associated with so the test can do a write on it.
         channelId = protocol.transport.id
 
         server.service.channels[channelId].write(b"hello, world")
-        pump.pump()
-        self.assertEqual(b"hello, world", b"".join(dataReceived))
+        pump.flush()
+        self.assertEqual(b"hello, world", bytes(dataReceived))
 
 
     def test_connectionLost(self):
@@ -521,9 +545,7 @@ class SSHCommandClientEndpointTestsMixin(object):
         self.realm.channelLookup[b'session'] = WorkingExecSession
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.finishConnection()
 
@@ -536,7 +558,7 @@ class SSHCommandClientEndpointTestsMixin(object):
         channelId = protocol.transport.id
         server.service.channels[channelId].loseConnection()
 
-        pump.pump()
+        pump.flush()
         connectionLost[0].trap(ConnectionDone)
 
         self.assertClientTransportState(client, False)
@@ -549,9 +571,7 @@ class SSHCommandClientEndpointTestsMixin(object):
         self.realm.channelLookup[b'session'] = WorkingExecSession
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.finishConnection()
 
@@ -567,7 +587,7 @@ class SSHCommandClientEndpointTestsMixin(object):
 
         server.service.sendRequest(channel, request, requestArg)
         channel.loseConnection()
-        pump.pump()
+        pump.flush()
         self.assertClientTransportState(client, False)
         return connectionLost[0]
 
@@ -676,9 +696,7 @@ class SSHCommandClientEndpointTestsMixin(object):
         self.realm.channelLookup[b'session'] = WorkingExecSession
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.finishConnection()
 
@@ -686,7 +704,7 @@ class SSHCommandClientEndpointTestsMixin(object):
 
         dataReceived = self.record(server, protocol, 'dataReceived')
         protocol.transport.write(b"hello, world")
-        pump.pump()
+        pump.flush()
         self.assertEqual(b"hello, world", b"".join(dataReceived))
 
 
@@ -698,17 +716,15 @@ class SSHCommandClientEndpointTestsMixin(object):
         self.realm.channelLookup[b'session'] = WorkingExecSession
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.finishConnection()
 
         protocol = self.successResultOf(connected)
 
         dataReceived = self.record(server, protocol, 'dataReceived')
-        protocol.transport.writeSequence([b"hello, world"])
-        pump.pump()
+        protocol.transport.writeSequence([b"hello, ", b"world"])
+        pump.flush()
         self.assertEqual(b"hello, world", b"".join(dataReceived))
 
 
@@ -725,14 +741,12 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         """
         SSHCommandClientEndpointTestsMixin.setUp(self)
         # Make the server's host key available to be verified by the client.
-        self.hostKeyPath = FilePath(self.mktemp())
-        self.knownHosts = KnownHostsFile(self.hostKeyPath)
+        self.knownHosts = _unsavedKnownHosts()
         self.knownHosts.addHostKey(
             self.hostname, self.factory.publicKeys[b'ssh-rsa'])
         self.knownHosts.addHostKey(
             networkString(self.serverAddress.host),
             self.factory.publicKeys[b'ssh-rsa'])
-        self.knownHosts.save()
 
 
     def create(self):
@@ -781,14 +795,11 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         pump.pump()
         self.assertEqual([None], closed)
 
-        # Let the last bit of network traffic flow.  This lets the server's
-        # close acknowledgement through, at which point the client can close
-        # the overall SSH connection.
-        pump.pump()
-
-        # Given that the client transport is disconnecting, report the
-        # disconnect from up to the ssh protocol.
-        client.transport.reportDisconnect()
+        # Let the rest of the network traffic flow.  This lets the server's
+        # close acknowledgement through, at which point the client closes the
+        # overall SSH connection and the pump reports the disconnect to both
+        # sides.
+        pump.flush()
 
 
     def assertClientTransportState(self, client, immediateClose):
@@ -844,9 +855,7 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
             self.reactor, b"/bin/ls -l", self.user, self.hostname, self.port,
             password=self.password, knownHosts=self.knownHosts,
             ui=FixedResponseUI(False))
-        factory = Factory()
-        factory.protocol = Protocol
-        endpoint.connect(factory)
+        endpoint.connect(_clientFactory)
 
         host, port, factory, timeout, bindAddress = self.reactor.tcpClients[0]
         self.assertEqual(self.hostname, networkString(host))
@@ -864,9 +873,7 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
             self.reactor, b"/bin/ls -l", b"dummy user",
             self.hostname, self.port, knownHosts=self.knownHosts,
             ui=FixedResponseUI(False))
-        factory = Factory()
-        factory.protocol = Protocol
-        d = endpoint.connect(factory)
+        d = endpoint.connect(_clientFactory)
 
         factory = self.reactor.tcpClients[0][2]
         factory.clientConnectionFailed(None, Failure(ConnectionRefusedError()))
@@ -881,14 +888,14 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         server, the L{Deferred} returned by L{SSHCommandClientEndpoint.connect}
         fires with a L{Failure} wrapping L{UserRejectedKey}.
         """
+        # The key is rejected, so nothing is ever added to this.
+        knownHosts = _unsavedKnownHosts()
         endpoint = SSHCommandClientEndpoint.newConnection(
             self.reactor, b"/bin/ls -l", b"dummy user",
-            self.hostname, self.port, knownHosts=KnownHostsFile(self.mktemp()),
+            self.hostname, self.port, knownHosts=knownHosts,
             ui=FixedResponseUI(False))
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.connectedServerAndClient(
             self.factory, self.reactor.tcpClients[0][2])
@@ -905,13 +912,12 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         L{Deferred} returned by L{SSHCommandClientEndpoint.connect} fires with
         a L{Failure} wrapping L{HostKeyChanged}.
         """
-        firstKey = Key.fromString(privateRSA_openssh).public()
-        knownHosts = KnownHostsFile(FilePath(self.mktemp()))
+        firstKey = _privateRSAKey.public()
+        knownHosts = _unsavedKnownHosts()
         knownHosts.addHostKey(
             networkString(self.serverAddress.host), firstKey)
         # Add a different RSA key with the same hostname
-        differentKey = Key.fromString(privateRSA_openssh_encrypted_aes,
-                                      passphrase=b'testxp').public()
+        differentKey = _differentRSAKey
         knownHosts.addHostKey(self.hostname, differentKey)
 
         # The UI may answer true to any questions asked of it; they should
@@ -924,9 +930,7 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
             self.hostname, self.port, password=b"dummy password",
             knownHosts=knownHosts, ui=ui)
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.connectedServerAndClient(
             self.factory, self.reactor.tcpClients[0][2])
@@ -948,9 +952,7 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
             self.hostname, self.port, knownHosts=self.knownHosts,
             ui=FixedResponseUI(False))
 
-        factory = Factory()
-        factory.protocol = Protocol
-        d = endpoint.connect(factory)
+        d = endpoint.connect(_clientFactory)
 
         transport = StringTransport()
         factory = self.reactor.tcpClients[0][2]
@@ -974,9 +976,7 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
             self.hostname, self.port, knownHosts=self.knownHosts,
             ui=FixedResponseUI(False))
 
-        factory = Factory()
-        factory.protocol = Protocol
-        d = endpoint.connect(factory)
+        d = endpoint.connect(_clientFactory)
 
         transport = AbortableFakeTransport(None, isServer=False)
         factory = self.reactor.tcpClients[0][2]
@@ -1001,9 +1001,7 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
             self.hostname, self.port, knownHosts=self.knownHosts,
             ui=FixedResponseUI(False))
 
-        factory = Factory()
-        factory.protocol = Protocol
-        d = endpoint.connect(factory)
+        d = endpoint.connect(_clientFactory)
         d.cancel()
         self.failureResultOf(d).trap(ConnectingCancelledError)
         self.assertTrue(self.reactor.connectors[0].stoppedConnecting)
@@ -1020,9 +1018,7 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
             self.hostname, self.port,  password=b"dummy password",
             knownHosts=self.knownHosts, ui=FixedResponseUI(False))
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.connectedServerAndClient(
             self.factory, self.reactor.tcpClients[0][2])
@@ -1052,12 +1048,11 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         @type portal: L{Portal}
 
         @param users: The users and their keys the checker will recognize.  Keys
-            are byte strings giving user names.  Values are byte strings giving
-            OpenSSH-formatted private keys.
+            are byte strings giving user names.  Values are L{Key} instances
+            giving their private keys.
         @type users: L{dict}
         """
-        mapping = dict([(k,[Key.fromString(v).public()])
-                        for k, v in iteritems(users)])
+        mapping = {k: [v.public()] for k, v in users.items()}
         checker = SSHPublicKeyChecker(InMemorySSHKeyDB(mapping))
         portal.registerChecker(checker)
 
@@ -1068,17 +1063,15 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         the L{Deferred} returned by L{SSHCommandClientEndpoint.connect} fires
         with a L{Failure} wrapping L{AuthenticationFailed}.
         """
-        badKey = Key.fromString(privateRSA_openssh)
-        self.setupKeyChecker(self.portal, {self.user: privateDSA_openssh})
+        badKey = _privateRSAKey
+        self.setupKeyChecker(self.portal, {self.user: _privateDSAKey})
 
         endpoint = SSHCommandClientEndpoint.newConnection(
             self.reactor, b"/bin/ls -l", self.user,
             self.hostname, self.port, keys=[badKey],
             knownHosts=self.knownHosts, ui=FixedResponseUI(False))
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.connectedServerAndClient(
             self.factory, self.reactor.tcpClients[0][2])
@@ -1098,17 +1091,15 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         If the SSH server does not accept any of the specified SSH keys, the
         specified password is tried.
         """
-        badKey = Key.fromString(privateRSA_openssh)
-        self.setupKeyChecker(self.portal, {self.user: privateDSA_openssh})
+        badKey = _privateRSAKey
+        self.setupKeyChecker(self.portal, {self.user: _privateDSAKey})
 
         endpoint = SSHCommandClientEndpoint.newConnection(
             self.reactor, b"/bin/ls -l", self.user, self.hostname, self.port,
             keys=[badKey], password=self.password, knownHosts=self.knownHosts,
             ui=FixedResponseUI(False))
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         # Exercising fallback requires a failed authentication attempt.  Allow
         # one.
@@ -1117,7 +1108,7 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         server, client, pump = self.connectedServerAndClient(
             self.factory, self.reactor.tcpClients[0][2])
 
-        pump.pump()
+        pump.flush()
 
         # The server logs the channel open failure - this is expected.
         errors = self.flushLoggedErrors(ConchError)
@@ -1140,17 +1131,15 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         If L{SSHCommandClientEndpoint} is initialized with any private keys, it
         will try to use them to authenticate with the SSH server.
         """
-        key = Key.fromString(privateDSA_openssh)
-        self.setupKeyChecker(self.portal, {self.user: privateDSA_openssh})
+        key = _privateDSAKey
+        self.setupKeyChecker(self.portal, {self.user: _privateDSAKey})
 
         self.realm.channelLookup[b'session'] = WorkingExecSession
         endpoint = SSHCommandClientEndpoint.newConnection(
             self.reactor, b"/bin/ls -l", self.user, self.hostname, self.port,
             keys=[key], knownHosts=self.knownHosts, ui=FixedResponseUI(False))
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.connectedServerAndClient(
             self.factory, self.reactor.tcpClients[0][2])
@@ -1168,14 +1157,12 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
             self.reactor, b"/bin/ls -l", self.user, self.hostname, self.port,
             knownHosts=self.knownHosts, ui=FixedResponseUI(False))
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.connectedServerAndClient(
             self.factory, self.reactor.tcpClients[0][2])
 
-        pump.pump()
+        pump.flush()
 
         # Now deal with the results on the endpoint side.
         f = self.failureResultOf(connected)
@@ -1193,12 +1180,12 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         server. Once the connection with the SSH server has concluded, the
         connection to the agent is disconnected.
         """
-        key = Key.fromString(privateRSA_openssh)
+        key = _privateRSAKey
         agentServer = SSHAgentServer()
         agentServer.factory = Factory()
         agentServer.factory.keys = {key.blob(): (key, b"")}
 
-        self.setupKeyChecker(self.portal, {self.user: privateRSA_openssh})
+        self.setupKeyChecker(self.portal, {self.user: _privateRSAKey})
 
         agentEndpoint = SingleUseMemoryEndpoint(agentServer)
         endpoint = SSHCommandClientEndpoint.newConnection(
@@ -1208,18 +1195,18 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
 
         self.realm.channelLookup[b'session'] = WorkingExecSession
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.connectedServerAndClient(
             self.factory, self.reactor.tcpClients[0][2])
 
         # Let the agent client talk with the agent server and the ssh client
-        # talk with the ssh server.
-        for i in range(14):
-            agentEndpoint.pump.pump()
-            pump.pump()
+        # talk with the ssh server until neither conversation makes progress.
+        while True:
+            agentMoved = agentEndpoint.pump.flush()
+            sshMoved = pump.flush()
+            if not (agentMoved or sshMoved):
+                break
 
         protocol = self.successResultOf(connected)
         self.assertIsNotNone(protocol.transport)
@@ -1240,9 +1227,7 @@ class NewConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         self.realm.channelLookup[b'session'] = WorkingExecSession
         endpoint = self.create()
 
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = endpoint.connect(factory)
+        connected = endpoint.connect(_clientFactory)
 
         server, client, pump = self.finishConnection()
 
@@ -1267,7 +1252,7 @@ class ExistingConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         """
         SSHCommandClientEndpointTestsMixin.setUp(self)
 
-        knownHosts = KnownHostsFile(FilePath(self.mktemp()))
+        knownHosts = _unsavedKnownHosts()
         knownHosts.addHostKey(
             self.hostname, self.factory.publicKeys[b'ssh-rsa'])
         knownHosts.addHostKey(
@@ -1285,21 +1270,22 @@ class ExistingConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         Create and return a new L{SSHCommandClientEndpoint} using the
         C{existingConnection} constructor.
         """
-        factory = Factory()
-        factory.protocol = Protocol
-        connected = self.endpoint.connect(factory)
+        connected = self.endpoint.connect(_clientFactory)
 
         # Please, let me in.  This kinda sucks.
-        channelLookup = self.realm.channelLookup.copy()
+        channelLookup = self.realm.channelLookup
+        missing = object()
+        previous = channelLookup.get(b'session', missing)
+        channelLookup[b'session'] = WorkingExecSession
         try:
-            self.realm.channelLookup[b'session'] = WorkingExecSession
-
             server, client, pump = self.connectedServerAndClient(
                 self.factory, self.reactor.tcpClients[0][2])
 
         finally:
-            self.realm.channelLookup.clear()
-            self.realm.channelLookup.update(channelLookup)
+            if previous is missing:
+                del channelLookup[b'session']
+            else:
+                channelLookup[b'session'] = previous
 
         self._server = server
         self._client = client
@@ -1319,10 +1305,7 @@ class ExistingConnectionTests(TestCase, SSHCommandClientEndpointTestsMixin):
         # The connection was set up and the first command channel set up, but
         # some more I/O needs to happen for the second command channel to be
         # ready.  Make that I/O happen before giving back the objects.
-        self._pump.pump()
-        self._pump.pump()
-        self._pump.pump()
-        self._pump.pump()
+        self._pump.flush()
         return self._server, self._client, self._pump
 
 
@@ -1419,6 +1402,21 @@ class NewConnectionHelperTests(TestCase):
     """
     Tests for L{_NewConnectionHelper}.
     """
+    def makeHelper(self, **kwargs):
+        """
+        Create a L{_NewConnectionHelper} with L{None} for all of its required
+        arguments.
+
+        @param kwargs: Additional keyword arguments, such as C{tty}, for
+            L{_NewConnectionHelper}.
+
+        @rtype: L{_NewConnectionHelper}
+        """
+        return _NewConnectionHelper(
+            None, None, None, None, None, None, None, None, None, None,
+            **kwargs)
+
+
     def test_interface(self):
         """
         L{_NewConnectionHelper} implements L{_ISSHConnectionCreator}.
@@ -1443,8 +1441,7 @@ class NewConnectionHelperTests(TestCase):
         result = object()
         self.patch(_NewConnectionHelper, '_knownHosts', lambda cls: result)
 
-        helper = _NewConnectionHelper(
-            None, None, None, None, None, None, None, None, None, None)
+        helper = self.makeHelper()
 
         self.assertIs(result, helper.knownHosts)
 
@@ -1455,7 +1452,7 @@ class NewConnectionHelperTests(TestCase):
         L{KnownHostsFile} created by L{_NewConnectionHelper} when none is
         supplied to it.
         """
-        key = CommandFactory().publicKeys[b'ssh-rsa']
+        key = _publicRSAKey
         path = FilePath(self.mktemp())
         knownHosts = KnownHostsFile(path)
         knownHosts.addHostKey(b"127.0.0.1", key)
@@ -1478,8 +1475,7 @@ class NewConnectionHelperTests(TestCase):
         If L{None} is passed for the C{ui} parameter to
         L{_NewConnectionHelper}, a L{ConsoleUI} is used.
         """
-        helper = _NewConnectionHelper(
-            None, None, None, None, None, None, None, None, None, None)
+        helper = self.makeHelper()
         self.assertIsInstance(helper.ui, ConsoleUI)
 
 
@@ -1490,8 +1486,7 @@ class NewConnectionHelperTests(TestCase):
         /dev/tty.
         """
         tty = _PTYPath(b"yes")
-        helper = _NewConnectionHelper(
-            None, None, None, None, None, None, None, None, None, None, tty)
+        helper = self.makeHelper(tty=tty)
         result = self.successResultOf(helper.ui.prompt(b"does this work?"))
         self.assertTrue(result)
 
@@ -1503,8 +1498,7 @@ class NewConnectionHelperTests(TestCase):
         some file which always produces a C{b"no"} response.
         """
         tty = FilePath(self.mktemp())
-        helper = _NewConnectionHelper(
-            None, None, None, None, None, None, None, None, None, None, tty)
+        helper = self.makeHelper(tty=tty)
         result = self.successResultOf(helper.ui.prompt(b"did this break?"))
         self.assertFalse(result)
 
@@ -1514,8 +1508,7 @@ class NewConnectionHelperTests(TestCase):
         If not passed the name of a tty in the filesystem,
         L{_NewConnectionHelper} uses C{b"/dev/tty"}.
         """
-        helper = _NewConnectionHelper(
-            None, None, None, None, None, None, None, None, None, None)
+        helper = self.makeHelper()
         self.assertEqual(FilePath(b"/dev/tty"), helper.tty)
 
 
@@ -1524,8 +1517,7 @@ class NewConnectionHelperTests(TestCase):
         L{_NewConnectionHelper.cleanupConnection} closes the transport cleanly
         if called with C{immediate} set to C{False}.
         """
-        helper = _NewConnectionHelper(
-            None, None, None, None, None, None, None, None, None, None)
+        helper = self.makeHelper()
         connection = SSHConnection()
         connection.transport = StringTransport()
         helper.cleanupConnection(connection, False)
@@ -1545,8 +1537,7 @@ class NewConnectionHelperTests(TestCase):
                 """
                 self.aborted = True
 
-        helper = _NewConnectionHelper(
-            None, None, None, None, None, None, None, None, None, None)
+        helper = self.makeHelper()
         connection = SSHConnection()
         connection.transport = SSHClientTransport()
         connection.transport.transport = Abortable()